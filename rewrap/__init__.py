@@ -41,6 +41,10 @@ selected, the current line will be selected and re-wrapped.
 The indentation (if any) of the first line will be used for all lines,
 and all other spaces and tabs will be ignored.
 
+The line breaks are chosen to fill the lines of a paragraph evenly,
+rather than filling each line as far as it will go and leaving a short
+last line.
+
 If you reformat multiple paragraphs, i.e. blocks of text separated by
 blank lines, one blank line will be maintained between them.
 
@@ -75,6 +79,7 @@ rewrap/                  -- Package directory
     __init__.py          -- Package module loaded by Gedit.
     rewrap.py            -- Plugin and plugin helper classes.
     logger.py            -- Module providing simple logging.
+    _rewrap_core.pyx     -- Optional Cython version of the line breaking.
     gpl.txt              -- GNU General Public License.
 
 How it loads:
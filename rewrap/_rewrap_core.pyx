@@ -0,0 +1,106 @@
+# -*- coding: utf8 -*-
+# cython: boundscheck=False, wraparound=False
+#
+#  Rewrap plugin for Gedit
+#
+#  Copyright (C) 2010 Derek Veit
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This optional module is a compiled version of get_line_starts from
+rewrap.py.  If it has not been built, rewrap.py uses its own pure Python
+version, which gives the same results.
+
+To build it in the rewrap directory:
+cythonize -i _rewrap_core.pyx
+This also leaves _rewrap_core.c here and a build directory beside the
+rewrap directory, both of which can be removed.
+"""
+
+from libc.stdlib cimport malloc, free
+
+def get_line_starts(word_widths, space_widths,
+                    Py_ssize_t first_indent_width, Py_ssize_t indent_width,
+                    max_line_length):
+    """
+    Return the indices of the words that begin lines, followed by the
+    number of words.
+
+    See rewrap.get_line_starts.
+    """
+    cdef Py_ssize_t count = len(word_widths)
+    if not max_line_length:
+        return [0, count]
+    cdef Py_ssize_t limit = max_line_length
+    cdef Py_ssize_t i, j, width, slack, cost
+    cdef list line_starts
+
+    cdef Py_ssize_t *spaces = <Py_ssize_t *>malloc(
+                                        (count + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t *totals = <Py_ssize_t *>malloc(
+                                        (count + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t *minima = <Py_ssize_t *>malloc(
+                                        (count + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t *starts = <Py_ssize_t *>malloc(
+                                        (count + 1) * sizeof(Py_ssize_t))
+    try:
+        if not (spaces and totals and minima and starts):
+            raise MemoryError()
+
+        # totals[i] is the width of the first i words with their spaces
+        totals[0] = 0
+        for i in range(count):
+            spaces[i] = space_widths[i]
+            totals[i + 1] = totals[i] + spaces[i] + word_widths[i]
+
+        # minima[j] is the least cost of the first j words (-1 for none yet)
+        minima[0] = 0
+        starts[0] = 0
+        for j in range(1, count + 1):
+            minima[j] = -1
+            starts[j] = 0
+            i = j - 1
+            while i >= 0:
+                if i == 0:
+                    width = first_indent_width
+                else:
+                    width = indent_width
+                width += totals[j] - totals[i] - spaces[i]
+                if width > limit and i < j - 1:
+                    if i == 0:
+                        break
+                    # Only the first line, with its own indentation, may fit
+                    i = 0
+                    continue
+                slack = limit - width if width < limit else 0
+                cost = minima[i] + slack * slack
+                if minima[j] < 0 or cost < minima[j]:
+                    minima[j] = cost
+                    starts[j] = i
+                i -= 1
+
+        # Trace the line starts back from the end of the paragraph
+        line_starts = [count]
+        j = count
+        while j:
+            j = starts[j]
+            line_starts.append(j)
+    finally:
+        free(spaces)
+        free(totals)
+        free(minima)
+        free(starts)
+    line_starts.reverse()
+    return line_starts
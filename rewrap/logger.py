@@ -75,6 +75,9 @@ class Logger(object):
                       'error': self.logger.error,
                       'critical': self.logger.critical}[level]
             logger(message)
+        elif not self.logger.isEnabledFor(logging.DEBUG):
+            # Skip inspecting the stack for messages that won't be shown.
+            return
         elif var:
             self.logger.debug('%s: %r' % (var, sys._getframe(1).f_locals[var]))
         else:
@@ -54,6 +54,10 @@ ACCELERATOR_UNWRAP = None
 ACCELERATOR_UNWRAP_TRAILING = None
 ACCELERATOR_CONFIGURE = None
 
+REWRAP_CACHE_SIZE = 32
+
+import collections
+import functools
 import json
 import os
 import re
@@ -67,6 +71,12 @@ LOGGER = Logger(level=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')[2])
 
 from .simpleconfigwindow import SimpleConfigWindow
 
+GEDIT_EDITOR_PREFERENCES = '/apps/gedit-2/preferences/editor'
+GEDIT_MARGIN_KEY = (GEDIT_EDITOR_PREFERENCES +
+                    '/right_margin/right_margin_position')
+GEDIT_TAB_WIDTH_KEY = GEDIT_EDITOR_PREFERENCES + '/tabs/tabs_size'
+GEDIT_INSERT_SPACES_KEY = GEDIT_EDITOR_PREFERENCES + '/tabs/insert_spaces'
+
 class RewrapPlugin(gedit.Plugin):
     
     """
@@ -207,6 +217,20 @@ class RewrapWindowHelper(object):
     
     """
     
+    __slots__ = (
+        '_plugin',
+        '_window',
+        '_menu_ui_id',
+        '_action_group',
+        '_start_iter',
+        '_end_iter',
+        '_gconf_client',
+        '_gconf_notify_ids',
+        '_margin',
+        '_tab_width',
+        '_using_hard_tabs',
+        )
+    
     def __init__(self, plugin, window):
         """Initialize attributes for this Rewrap instance."""
         LOGGER.log()
@@ -226,12 +250,25 @@ class RewrapWindowHelper(object):
         """The start the text selection."""
         self._end_iter = None
         """The end of the text selection."""
+        
+        self._gconf_client = gconf.client_get_default()
+        """The GConf client providing Gedit's preference settings."""
+        self._gconf_notify_ids = []
+        """The preference change notifications, saved for removal."""
+        
+        self._margin = None
+        """The preference setting for the right margin, e.g. 80."""
+        self._tab_width = None
+        """The preference setting for the tab width, e.g. 4."""
+        self._using_hard_tabs = None
+        """The preference setting for indentation characters."""
     
     # Public methods
     
     def activate(self):
         """Start this instance of Rewrap."""
         LOGGER.log()
+        self._watch_preferences()
         self._insert_menu()
         self.update_ui(self._window)
         LOGGER.log('Rewrap started for %s' % self._window)
@@ -240,6 +277,7 @@ class RewrapWindowHelper(object):
         """End this instance of Rewrap."""
         LOGGER.log()
         self._remove_menu()
+        self._unwatch_preferences()
         LOGGER.log('Rewrap stopped for %s' % self._window)
         self._window = None
     
@@ -251,6 +289,41 @@ class RewrapWindowHelper(object):
         if document and view and view.get_editable():
             self._action_group.set_sensitive(True)
     
+    # Preferences
+    
+    def _watch_preferences(self):
+        """Read Gedit's preference settings and follow any changes."""
+        LOGGER.log()
+        self._gconf_client.add_dir(GEDIT_EDITOR_PREFERENCES,
+                                   gconf.CLIENT_PRELOAD_NONE)
+        self._read_preferences()
+        self._gconf_notify_ids = [
+            self._gconf_client.notify_add(key, self._on_preference_changed)
+            for key in (GEDIT_MARGIN_KEY,
+                        GEDIT_TAB_WIDTH_KEY,
+                        GEDIT_INSERT_SPACES_KEY)]
+    
+    def _unwatch_preferences(self):
+        """Stop following Gedit's preference settings."""
+        LOGGER.log()
+        for notify_id in self._gconf_notify_ids:
+            self._gconf_client.notify_remove(notify_id)
+        self._gconf_notify_ids = []
+        self._gconf_client.remove_dir(GEDIT_EDITOR_PREFERENCES)
+    
+    def _read_preferences(self):
+        """Store the current values of Gedit's preference settings."""
+        LOGGER.log()
+        client = self._gconf_client
+        self._margin = client.get_int(GEDIT_MARGIN_KEY)
+        self._tab_width = client.get_int(GEDIT_TAB_WIDTH_KEY)
+        self._using_hard_tabs = not client.get_bool(GEDIT_INSERT_SPACES_KEY)
+    
+    def _on_preference_changed(self, client, cnxn_id, entry, *user_data):
+        """Update the stored preference settings when one changes."""
+        LOGGER.log()
+        self._read_preferences()
+    
     # Menu
     
     def _insert_menu(self):
@@ -356,46 +429,19 @@ class RewrapWindowHelper(object):
         preceding_text, text = self._get_text_selection(trailing)
         if not text:
             return
-        text += '\n\n'
         
         # Get the wrapping parameters
-        max_line_length = get_gedit_margin() if wrap else None
-        tab_width = get_gedit_tab_width()
-        
-        indent = re.match('[%s]*' % indent_chars, text).group(0)
-        
-        offset = (len(preceding_text) +
-                  preceding_text.count('\t') * (tab_width - 1))
-        if get_gedit_using_hard_tabs():
-            trailing_indent = ('\t' * (offset // tab_width) +
-                               ' ' * (offset % tab_width))
-        else:
-            trailing_indent = ' ' * offset
-        
-        # Remove any pre-existing indentation
-        text = '\n'.join(
-                line.lstrip(indent_chars) for line in text.splitlines())
+        max_line_length = self._margin if wrap else None
+        sentence_spacing = self._plugin.config['Sentence spacing']['value']
+        indent_empty_lines = self._plugin.config['Indent empty lines']['value']
         
-        paragraphs = get_paragraphs(text)
-        if not paragraphs:
+        output = rewrap_text(text, preceding_text, indent_chars,
+                             max_line_length, self._tab_width,
+                             self._using_hard_tabs, sentence_spacing,
+                             indent_empty_lines)
+        if output is None:
             return
         
-        # Re-wrap the paragraphs
-        sentence_spacing = self._plugin.config['Sentence spacing']['value']
-        new_paragraphs = (
-            [format_paragraph(paragraphs[0], indent, trailing_indent, offset,
-                              max_line_length, tab_width, sentence_spacing)] +
-            [format_paragraph(paragraph, trailing_indent + indent, '', 0,
-                              max_line_length, tab_width, sentence_spacing) for
-                              paragraph in paragraphs[1:]])
-        
-        # Combine the paragraphs
-        if self._plugin.config['Indent empty lines']['value']:
-            blank_line = trailing_indent + indent + '\n'
-        else:
-            blank_line = '\n'
-        output = blank_line.join(new_paragraphs)
-        
         # Replace the selected text with the reformatted text
         self._replace_text_selection(output)
     
@@ -435,8 +481,18 @@ class RewrapWindowHelper(object):
             else:
                 self._end_iter.forward_line()
         
+        # Skip copying out the text if there is none, e.g. on a blank last line
+        if self._start_iter.equal(self._end_iter):
+            return preceding_text, ''
+        
         selected_text = document.get_text(self._start_iter,
                                           self._end_iter)
+        
+        # PyGTK returns UTF-8 bytes, but widths are measured in characters
+        if isinstance(preceding_text, bytes):
+            preceding_text = preceding_text.decode('utf-8')
+        if isinstance(selected_text, bytes):
+            selected_text = selected_text.decode('utf-8')
         return preceding_text, selected_text
     
     def _replace_text_selection(self, text):
@@ -462,89 +518,205 @@ class RewrapWindowHelper(object):
         # (The insert is already at the new end.)
         new_start_iter = document.get_iter_at_mark(start_mark)
         document.move_mark_by_name("selection_bound", new_start_iter)
+        document.delete_mark(start_mark)
         
         document.end_user_action()
 
-def get_gedit_margin():
-    """Return the the preference setting for the right margin, e.g. 80."""
-    LOGGER.log()
-    gconf_client = gconf.client_get_default()
-    margin = gconf_client.get_int('/apps/gedit-2/preferences/editor/'
-                                  'right_margin/right_margin_position')
-    return margin
+def memoize(size):
+    """Return a decorator caching a function's most recent results."""
+    def decorator(function):
+        cache = {}
+        # The cached arguments, from least to most recently used
+        keys = collections.deque()
+        @functools.wraps(function)
+        def wrapper(*args):
+            if args in cache:
+                keys.remove(args)
+            else:
+                cache[args] = function(*args)
+                if len(keys) >= size:
+                    del cache[keys.popleft()]
+            keys.append(args)
+            return cache[args]
+        return wrapper
+    return decorator
 
-def get_gedit_tab_width():
-    """Return the the preference setting for the tab width, e.g. 4."""
+@memoize(REWRAP_CACHE_SIZE)
+def rewrap_text(text, preceding_text, indent_chars, max_line_length,
+                tab_width, using_hard_tabs, sentence_spacing,
+                indent_empty_lines):
+    """
+    Return the text re-wrapped, or None if it has no paragraphs.
+    
+    This depends only on its arguments, so recent results are cached for
+    repeated rewraps of the same text, e.g. after an undo.
+    """
     LOGGER.log()
-    gconf_client = gconf.client_get_default()
-    tab_width = gconf_client.get_int('/apps/gedit-2/preferences/editor/'
-                                  'tabs/tabs_size')
-    return tab_width
+    
+    # Take the indentation from the leading characters of the first line
+    indent_char_set = frozenset(indent_chars)
+    i = 0
+    while i < len(text) and text[i] in indent_char_set:
+        i += 1
+    indent = text[:i]
+    
+    offset = get_text_width(preceding_text, tab_width)
+    if using_hard_tabs:
+        trailing_indent = ('\t' * (offset // tab_width) +
+                           ' ' * (offset % tab_width))
+    else:
+        trailing_indent = ' ' * offset
+    
+    # Remove any pre-existing indentation, at line starts after '\n' or '\r'
+    if indent_chars:
+        text = re.sub(r'(?m)(?:^|(?<=\r))[%s]+' % re.escape(indent_chars),
+                      '', text)
+    
+    paragraphs = get_paragraphs(text)
+    if not paragraphs:
+        return None
+    
+    # Re-wrap the paragraphs
+    new_paragraphs = (
+        [format_paragraph(paragraphs[0], indent, trailing_indent, offset,
+                          max_line_length, tab_width, sentence_spacing)] +
+        [format_paragraph(paragraph, trailing_indent + indent, '', 0,
+                          max_line_length, tab_width, sentence_spacing) for
+                          paragraph in paragraphs[1:]])
+    
+    # Combine the paragraphs
+    if indent_empty_lines:
+        blank_line = trailing_indent + indent + '\n'
+    else:
+        blank_line = '\n'
+    output = blank_line.join(new_paragraphs)
+    return output
 
-def get_gedit_using_hard_tabs():
-    """Return the the preference setting for indentation characters."""
-    LOGGER.log()
-    gconf_client = gconf.client_get_default()
-    using_spaces = gconf_client.get_bool('/apps/gedit-2/preferences/editor/'
-                                  'tabs/insert_spaces')
-    using_hard_tabs = not using_spaces
-    return using_hard_tabs
+def get_text_width(text, tab_width):
+    """Return the displayed width of the text, counting tabs as tab_width."""
+    return len(text) + text.count('\t') * (tab_width - 1)
 
 def get_paragraphs(text):
-    """Return a list of the paragraphs in the text."""
+    """Return a list of the paragraphs in the text, each a list of words."""
     LOGGER.log()
-    word_re = r'[ \t]*\S+'
-    line_re = r'^(?:' + word_re + r')+[ \t]*\n'
-    paragraph_re = r'(?:' + line_re + ')+'
-    paragraphs = re.findall(paragraph_re, text, re.MULTILINE)
+    paragraphs = []
+    words = []
+    # Blank lines end paragraphs, as does the end of the text
+    for line in text.splitlines() + ['']:
+        line_words = line.split()
+        if line_words:
+            words.extend(line_words)
+        elif words:
+            paragraphs.append(words)
+            words = []
     return paragraphs
 
-def format_paragraph(paragraph, indent, trailing_indent, offset,
+def format_paragraph(words, indent, trailing_indent, offset,
                      max_line_length, tab_width, sentence_spacing):
-    """Re-wrap the text of one paragraph."""
-    LOGGER.log()
-    
-    indent_width = len(indent) + indent.count('\t') * (tab_width - 1)
-    
-    new_paragraph = ''
-    
-    # Get a list of the words in the paragraph
-    words = re.findall('\S+', paragraph)
+    """Re-wrap the words of one paragraph."""
+    
+    indent_width = get_text_width(indent, tab_width)
+    
+    # Determine the space that goes before each word
+    spaces = ['']
+    for previous_word, word in zip(words, words[1:]):
+        # Determine space between words or sentences
+        if sentence_spacing:
+            is_after_period = previous_word[-1] == '.'
+            is_before_capital = 'A' <= word[0] <= 'Z'
+            is_between_sentences = is_after_period and is_before_capital
+            space = '  ' if is_between_sentences else ' '
+        else:
+            space = ' '
+        spaces.append(space)
     
-    # For trailing comments, start the first line and add the extra indentation
+    # For trailing comments, start the first line after the preceding text
+    # and add the extra indentation to the following lines
+    first_indent = indent
+    first_indent_width = offset + indent_width
     if offset:
-        word = words[0]
-        words = words[1:]
-        new_paragraph = indent + word
-        offset += indent_width + len(word)
-        trailing_indent_width = (len(trailing_indent) +
-                             trailing_indent.count('\t') * (tab_width - 1))
+        trailing_indent_width = get_text_width(trailing_indent, tab_width)
         indent = trailing_indent + indent
         indent_width = trailing_indent_width + indent_width
     
-    for word in words:
-        # Add a successive word in a line
-        if offset != 0:
-            # Determine space between words or sentences
-            if sentence_spacing:
-                is_after_period = new_paragraph[-1] == '.'
-                is_before_capital = word[0] in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-                is_between_sentences = is_after_period and is_before_capital
-                space = '  ' if is_between_sentences else ' '
-            else:
-                space = ' '
-            # Add the word or start a new line
-            potential_offset = offset + len(space) + len(word)
-            if potential_offset <= max_line_length or not max_line_length:
-                new_paragraph = space.join([new_paragraph, word])
-                offset = potential_offset
-            else:
-                new_paragraph += '\n'
-                offset = 0
-        # Indent and add the first word in a line
-        if offset == 0:
-            new_paragraph = indent.join([new_paragraph, word])
-            offset = indent_width + len(word)
-    new_paragraph += '\n'
+    starts = get_line_starts([len(word) for word in words],
+                             [len(space) for space in spaces],
+                             first_indent_width, indent_width,
+                             max_line_length)
+    
+    # Assemble the lines, collecting the pieces to join only once
+    parts = [first_indent]
+    for start, end in zip(starts, starts[1:]):
+        if start != 0:
+            parts.append('\n')
+            parts.append(indent)
+        parts.append(words[start])
+        for i in range(start + 1, end):
+            parts.append(spaces[i])
+            parts.append(words[i])
+    parts.append('\n')
+    new_paragraph = ''.join(parts)
     return new_paragraph
 
+def get_line_starts(word_widths, space_widths, first_indent_width,
+                    indent_width, max_line_length):
+    """
+    Return the indices of the words that begin lines, followed by the
+    number of words.
+    
+    The line breaks are chosen to minimize the sum of the squares of the
+    space left at the ends of the lines (as in TeX's optimal fit), so
+    that the lines are evenly filled instead of leaving a short last line.
+    A word too long for any line gets a line of its own.
+    """
+    count = len(word_widths)
+    if not max_line_length:
+        return [0, count]
+    
+    # totals[i] is the width of the first i words with their preceding spaces
+    totals = [0]
+    for word_width, space_width in zip(word_widths, space_widths):
+        totals.append(totals[-1] + space_width + word_width)
+    
+    # A line of words i to j is totals[j] - offsets[i] wide, with the line's
+    # indentation and the space before its first word folded into offsets[i]
+    offsets = [totals[i] + space_widths[i] -
+               (indent_width if i else first_indent_width)
+               for i in range(count)]
+    
+    # minima[j] is the least cost of breaking the first j words into lines,
+    # and starts[j] is where the last of those lines begins
+    minima = [0] + [None] * count
+    starts = [0] * (count + 1)
+    for j in range(1, count + 1):
+        total = totals[j]
+        least = None
+        i = j - 1
+        while i >= 0:
+            width = total - offsets[i]
+            if width > max_line_length and i < j - 1:
+                if i == 0:
+                    break
+                # Only the first line, with its own indentation, may still fit
+                i = 0
+                continue
+            slack = max_line_length - width if width < max_line_length else 0
+            cost = minima[i] + slack * slack
+            if least is None or cost < least:
+                least = cost
+                starts[j] = i
+            i -= 1
+        minima[j] = least
+    
+    # Trace the line starts back from the end of the paragraph
+    line_starts = [count]
+    while line_starts[-1]:
+        line_starts.append(starts[line_starts[-1]])
+    line_starts.reverse()
+    return line_starts
+
+# Use the compiled version of get_line_starts if it has been built.
+try:
+    from ._rewrap_core import get_line_starts
+except ImportError:
+    pass